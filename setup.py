@@ -4,7 +4,9 @@
 import ast
 import os
 import re
+import sys
 from setuptools import setup, find_packages
+from setuptools.command.build_py import build_py
 
 SOURCE_DIR = "src/ephemeris"
 
@@ -38,6 +40,19 @@ ENTRY_POINTS = '''
         galaxy-wait=ephemeris.sleep:main
         install_tool_deps=ephemeris.install_tool_deps:main
 '''
+# Modules using Python 3 only syntax, left out when installing on Python 2.
+PY3_ONLY_MODULES = ['shed_tools_async']
+
+
+class BuildPy(build_py):
+
+    def find_package_modules(self, package, package_dir):
+        modules = build_py.find_package_modules(self, package, package_dir)
+        if sys.version_info[0] < 3:
+            modules = [m for m in modules if not (m[0] == PROJECT_NAME and m[1] in PY3_ONLY_MODULES)]
+        return modules
+
+
 PACKAGE_DATA = {
     # Be sure to update MANIFEST.in for source dist.
 }
@@ -74,6 +89,9 @@ setup(
     package_dir={'': 'src'},
     include_package_data=True,
     install_requires=requirements,
+    # Concurrent tool shed queries, see shed_tools_async
+    extras_require={'async': ["aiohttp ; python_version >= '3.5'"]},
+    cmdclass={'build_py': BuildPy},
     license="AFL",
     zip_safe=False,
     keywords='galaxy',
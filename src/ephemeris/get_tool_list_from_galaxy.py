@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 """Tool to extract a tool list from galaxy."""
 
+import re
 from argparse import ArgumentDefaultsHelpFormatter
 from argparse import ArgumentParser
 from distutils.version import StrictVersion
@@ -13,6 +14,8 @@ from . import get_galaxy_connection
 from .common_parser import get_common_args
 from .shed_tools_methods import format_tool_shed_url
 
+TOOL_SHED_SCHEME_RE = re.compile('^https?://')
+
 
 def get_tool_panel(gi):
     tool_client = ToolClient(gi)
@@ -118,20 +121,16 @@ class GiToToolYaml:
             tools_with_panel = repositories[:]
             tsc = ToolShedClient(self.gi)
             repos = tsc.get_repositories()
-            # Hereafter follows a gruesomely ineffecient algorithm.
-            # The for loop and if statement are needed to retrieve tool_panel
-            # section labels and ids.
-            # If someone knows a more effecient way around this problem it
-            # will be greatly appreciated.
+            # The tool panel section labels and ids are retrieved from the repositories
+            # with tools in the panel, indexed once. The first occurrence of a repository wins.
+            panel_index = {}
+            for repo_with_panel in tools_with_panel:
+                panel_index.setdefault(repository_key(repo_with_panel, check_revision=False), repo_with_panel)
             for repo in repos:
                 if not repo['deleted']:
-                    tool_panel_section_id = None
-                    tool_panel_section_label = None
-                    for repo_with_panel in tools_with_panel:
-                        if the_same_repository(repo_with_panel, repo, check_revision=False):
-                            tool_panel_section_id = repo_with_panel.get('tool_panel_section_id')
-                            tool_panel_section_label = repo_with_panel.get('tool_panel_section_label')
-                            break
+                    repo_with_panel = panel_index.get(repository_key(repo, check_revision=False), {})
+                    tool_panel_section_id = repo_with_panel.get('tool_panel_section_id')
+                    tool_panel_section_label = repo_with_panel.get('tool_panel_section_label')
                     repositories.append(
                         dict(name=repo.get('name'),
                              owner=repo.get('owner'),
@@ -172,16 +171,27 @@ def the_same_repository(repo_1_info, repo_2_info, check_revision=True):
     repository.
     Each of the dicts must have the following keys: `changeset_revisions`( if check revisions is true), `name`, `owner`, and
     (either `tool_shed` or `tool_shed_url`).
+    To compare many repositories, index them by `repository_key` instead.
+    """
+    return repository_key(repo_1_info, check_revision) == repository_key(repo_2_info, check_revision)
+
+
+def repository_key(repo_info, check_revision=True):
+    """
+    Return a hashable key identifying a repository. Two repositories are the
+    same repository if their keys are equal, so the keys can be used for set
+    and dict lookups instead of pairwise comparisons.
+    The scheme and trailing slash of the tool shed url are stripped, because Galaxy
+    reports the tool shed of installed repositories without a scheme. So
+    `localhost:9009`, `http://localhost:9009` and `https://localhost:9009/` give the same key.
     """
-    # Sort from most unique to least unique for fast comparison.
-    if not check_revision or repo_1_info.get('changeset_revision') == repo_2_info.get('changeset_revision'):
-        if repo_1_info.get('name') == repo_2_info.get('name'):
-            if repo_1_info.get('owner') == repo_2_info.get('owner'):
-                t1ts = repo_1_info.get('tool_shed', repo_1_info.get('tool_shed_url', None))
-                t2ts = repo_2_info.get('tool_shed', repo_2_info.get('tool_shed_url', None))
-                if t1ts in t2ts or t2ts in t1ts:
-                    return True
-    return False
+    tool_shed = repo_info.get('tool_shed', repo_info.get('tool_shed_url', None))
+    if tool_shed is not None:
+        tool_shed = TOOL_SHED_SCHEME_RE.sub('', tool_shed).rstrip('/')
+    key = (repo_info.get('name'), repo_info.get('owner'), tool_shed)
+    if check_revision:
+        key += (repo_info.get('changeset_revision'),)
+    return key
 
 
 def merge_repository_changeset_revisions(repository_list):
@@ -37,11 +37,18 @@ import datetime as dt
 import json
 import os
 import re
+import threading
 import time
 from collections import namedtuple
 from concurrent.futures import thread, ThreadPoolExecutor
 
+try:
+    from time import monotonic
+except ImportError:  # Python 2
+    from time import time as monotonic
+
 import requests
+import six
 import yaml
 from bioblend.galaxy.client import ConnectionError
 from bioblend.galaxy.toolshed import ToolShedClient
@@ -53,9 +60,18 @@ from galaxy.util import unicodify
 
 from . import get_galaxy_connection, load_yaml_file
 from .ephemeris_log import disable_external_library_logging, setup_global_logger
-from .get_tool_list_from_galaxy import GiToToolYaml, the_same_repository, tools_for_repository
+from .get_tool_list_from_galaxy import GiToToolYaml, repository_key, tools_for_repository
 from .shed_tools_args import parser
-from .shed_tools_methods import complete_repo_information, flatten_repo_info, VALID_KEYS
+from .shed_tools_methods import (
+    complete_repo_information,
+    enable_revision_cache,
+    flatten_repo_info,
+    format_tool_shed_url,
+    prefetch_installable_revisions,
+    save_revision_cache,
+    VALID_KEYS,
+    validate_repositories,
+)
 
 NON_TERMINAL_REPOSITORY_STATES = {
     'New',
@@ -65,6 +81,22 @@ NON_TERMINAL_REPOSITORY_STATES = {
     'Installing tool dependencies',
     'Loading proprietary datatypes'
 }
+# Seconds between status checks in `InstallRepositoryManager.wait_for_install`
+WAIT_FOR_INSTALL_INITIAL_SLEEP = 2
+WAIT_FOR_INSTALL_MAX_SLEEP = 60
+ALREADY_INSTALLED_ERROR_MESSAGE = ('All repositories that you are attempting to install '
+                                   'have been previously installed.')
+
+# Maps the return values of `InstallRepositoryManager.install_repository_revision` to result events
+INSTALL_RESULT_EVENTS = {
+    "installed": "installed",
+    "skipped": "skipped",
+    "error": "errored",
+}
+
+FilterResults = namedtuple("FilterResults", ["not_installed_repos", "already_installed_repos"])
+InstallResults = namedtuple("InstallResults", ["installed_repositories", "errored_repositories", "skipped_repositories"])
+Results = namedtuple("Results", ["tool_test_results", "tests_passed", "test_exceptions"])
 
 
 class InstallRepositoryManager(object):
@@ -75,38 +107,57 @@ class InstallRepositoryManager(object):
         """Initialize a new tool manager"""
         self.gi = galaxy_instance
         self.tool_shed_client = ToolShedClient(self.gi)
+        self._installed_repositories = None
+        self._installed_index = None
 
-    def installed_repositories(self):
-        """Get currently installed tools"""
-        return GiToToolYaml(
-            gi=self.gi,
-            skip_tool_panel_section_name=False,
-            get_data_managers=True,
-            get_all_tools=True
-        ).tool_list.get("tools")
+    def installed_repositories(self, refresh=False):
+        """
+        Get currently installed tools.
+        The result is cached, as building it requires several calls to the Galaxy API.
+        The cache is cleared whenever a repository is installed, use ``refresh=True``
+        to force a new request otherwise.
+        """
+        if refresh or self._installed_repositories is None:
+            self._installed_index = None
+            self._installed_repositories = GiToToolYaml(
+                gi=self.gi,
+                skip_tool_panel_section_name=False,
+                get_data_managers=True,
+                get_all_tools=True
+            ).tool_list.get("tools")
+        return self._installed_repositories
+
+    def installed_index(self):
+        """
+        Index of the installed repositories.
+        Maps the ``(name, owner, tool_shed_url)`` key of each installed repository
+        to the set of its installed changeset revisions.
+        """
+        installed_repositories = self.installed_repositories()
+        if self._installed_index is None:
+            installed_index = {}
+            for installed_repo in installed_repositories:
+                key = repository_key(installed_repo, check_revision=False)
+                installed_index.setdefault(key, set()).update(installed_repo.get('revisions') or [])
+            self._installed_index = installed_index
+        return self._installed_index
+
+    def _clear_installed_repositories(self):
+        self._installed_repositories = None
+        self._installed_index = None
 
     def filter_installed_repos(self, repos, check_revision=True):
-        # TODO: Find a speedier algorithm.
         """This filters a list of repositories"""
         not_installed_repos = []
         already_installed_repos = []
-        if check_revision:
-            # If we want to check if revisions are equal, flatten the list,
-            # so each repository - revision combination has its own entry
-            installed_repos = flatten_repo_info(self.installed_repositories())
-        else:
-            # If we do not care about revision equality, do not do the flatten
-            # action to limit the number of comparisons.
-            installed_repos = self.installed_repositories()
+        installed_index = self.installed_index()
 
         for repo in repos:
-            for installed_repo in installed_repos:
-                if the_same_repository(installed_repo, repo, check_revision):
-                    already_installed_repos.append(repo)
-                    break
-            else:  # This executes when the for loop completes and no match has been found.
+            installed_revisions = installed_index.get(repository_key(repo, check_revision=False))
+            if installed_revisions is not None and (not check_revision or repo.get('changeset_revision') in installed_revisions):
+                already_installed_repos.append(repo)
+            else:
                 not_installed_repos.append(repo)
-        FilterResults = namedtuple("FilterResults", ["not_installed_repos", "already_installed_repos"])
         return FilterResults(already_installed_repos=already_installed_repos, not_installed_repos=not_installed_repos)
 
     def install_repositories(self,
@@ -116,11 +167,21 @@ class InstallRepositoryManager(object):
                              default_toolshed='https://toolshed.g2.bx.psu.edu/',
                              default_install_tool_dependencies=False,
                              default_install_resolver_dependencies=True,
-                             default_install_repository_dependencies=True):
-        """Install a list of tools on the current galaxy"""
+                             default_install_repository_dependencies=True,
+                             parallel_installs=1,
+                             fail_fast=True,
+                             results_json=None):
+        """
+        Install a list of tools on the current galaxy.
+        With ``fail_fast``, all repositories are checked for missing information before
+        contacting the tool shed, and a single ValueError listing all problems is raised.
+        Otherwise such repositories are reported as errored repositories.
+        If ``results_json`` is a path, the result for each repository is written to it
+        as a line of JSON as soon as it is known.
+        """
         if not repositories:
             raise ValueError("Empty list of tools was given")
-        installation_start = dt.datetime.now()
+        installation_start = monotonic()
         installed_repositories = []
         skipped_repositories = []
         errored_repositories = []
@@ -133,14 +194,112 @@ class InstallRepositoryManager(object):
                     if log:
                         log.warning("'{0}' not a valid key. Will be skipped during parsing".format(key))
 
-        # Start by flattening the repo list per revision
+        if fail_fast:
+            problems = validate_repositories(repositories, require_tool_panel_info=True)
+            if problems:
+                raise ValueError("Invalid tool list:\n{0}".format("\n".join(problems)))
+
+        # Start by flattening the repo list per revision, and drop repeated entries
         flattened_repos = flatten_repo_info(repositories)
+        if force_latest_revision:
+            # Every listed revision resolves to the latest installable revision,
+            # so only a single entry per repository is needed.
+            flattened_repos = [dict(repo, changeset_revision=None) for repo in flattened_repos]
+        flattened_repos = unique_repositories(flattened_repos, default_toolshed)
         total_num_repositories = len(flattened_repos)
 
-        # Complete the repo information, and make sure each repository has a revision
-        repository_list = []
-        for repository in flattened_repos:
-            start = dt.datetime.now()
+        # Look up the revisions that need to be resolved concurrently, when aiohttp is available.
+        prefetch_installable_revisions(revisions_to_prefetch(flattened_repos, default_toolshed, force_latest_revision))
+
+        prepared_repos = self._prepare_repositories(
+            flattened_repos,
+            log=log,
+            default_toolshed=default_toolshed,
+            default_install_tool_dependencies=default_install_tool_dependencies,
+            default_install_resolver_dependencies=default_install_resolver_dependencies,
+            default_install_repository_dependencies=default_install_repository_dependencies,
+            force_latest_revision=force_latest_revision)
+
+        # Install repos while the remaining ones are being prepared.
+        # Results are recorded as soon as they are known, installs record theirs from the worker thread.
+        results_lock = threading.Lock()
+        results_by_event = {
+            "installed": installed_repositories,
+            "skipped": skipped_repositories,
+            "errored": errored_repositories,
+        }
+
+        def record_result(event, repository, duration=None):
+            with results_lock:
+                results_by_event[event].append(repository)
+                results_writer.write(event, repository, duration)
+
+        def record_install_result(repository):
+            def callback(future):
+                if future.exception() is None:
+                    result, duration = future.result()
+                    record_result(INSTALL_RESULT_EVENTS[result], repository, duration)
+                else:
+                    # _install_repository reports install errors itself, keep the results complete regardless.
+                    if log:
+                        log.error("Installing repository %s failed: %s", repository.get('name', ""), future.exception())
+                    record_result("errored", repository)
+            return callback
+
+        with ResultsJsonWriter(results_json) as results_writer, ThreadPoolExecutor(max_workers=parallel_installs) as executor:
+            for repository, status in prepared_repos:
+                if status == "error":
+                    record_result("errored", repository)
+                    continue
+                counter += 1
+                if status == "skip":
+                    if log:
+                        log_repository_install_skip(repository, counter, total_num_repositories, log)
+                    record_result("skipped", repository)
+                    continue
+                future = executor.submit(self._install_repository,
+                                         repository=repository,
+                                         counter=counter,
+                                         total_num_repositories=total_num_repositories,
+                                         installation_start=installation_start,
+                                         log=log)
+                future.add_done_callback(record_install_result(repository))
+
+        save_revision_cache()
+
+        # Log results
+        if log:
+            # The repository lists are only formatted if the messages are emitted.
+            log.info("Installed repositories (%d): %s",
+                     len(installed_repositories), LazyRepositoryList(installed_repositories))
+            log.info("Skipped repositories (%d): %s",
+                     len(skipped_repositories), LazyRepositoryList(skipped_repositories))
+            log.info("Errored repositories (%d): %s",
+                     len(errored_repositories), LazyRepositoryList(errored_repositories, default_revision=""))
+            log.info("All repositories have been installed.")
+            log.info("Total run time: {0}".format(elapsed_time(installation_start)))
+        return InstallResults(installed_repositories=installed_repositories,
+                              skipped_repositories=skipped_repositories,
+                              errored_repositories=errored_repositories)
+
+    def _prepare_repositories(self,
+                              repositories,
+                              log,
+                              default_toolshed,
+                              default_install_tool_dependencies,
+                              default_install_resolver_dependencies,
+                              default_install_repository_dependencies,
+                              force_latest_revision):
+        """
+        Complete the information of each (flattened) repository, make sure it has a revision
+        and check whether it is already installed, in a single pass.
+        Yields ``(repository, status)`` tuples, where status is one of
+        ``"install"``, ``"skip"`` (already installed) or ``"error"``.
+        """
+        # The installed repositories are looked up once, installing repositories clears the cache.
+        installed_index = self.installed_index()
+        for repository in repositories:
+            start = monotonic()
             try:
                 complete_repo = complete_repo_information(
                     repository,
@@ -150,70 +309,24 @@ class InstallRepositoryManager(object):
                     default_install_resolver_dependencies=default_install_resolver_dependencies,
                     default_install_repository_dependencies=default_install_repository_dependencies,
                     force_latest_revision=force_latest_revision)
-                repository_list.append(complete_repo)
             except Exception as e:
                 # We'll run through the loop come whatever may, we log the errored repositories at the end anyway.
                 if log:
                     log_repository_install_error(repository, start, unicodify(e), log)
-                errored_repositories.append(repository)
-
-        # Filter out already installed repos
-        filtered_repos = self.filter_installed_repos(repository_list)
-
-        for skipped_repo in filtered_repos.already_installed_repos:
-            counter += 1
-            if log:
-                log_repository_install_skip(skipped_repo, counter, total_num_repositories, log)
-            skipped_repositories.append(skipped_repo)
-
-        # Install repos
-        for repository in filtered_repos.not_installed_repos:
-            counter += 1
-            if log:
-                log_repository_install_start(repository, counter=counter, installation_start=installation_start, log=log,
-                                             total_num_repositories=total_num_repositories)
-            result = self.install_repository_revision(repository, log)
-            if result == "error":
-                errored_repositories.append(repository)
-            elif result == "skipped":
-                skipped_repositories.append(repository)
-            elif result == "installed":
-                installed_repositories.append(repository)
-
-        # Log results
-        if log:
-            log.info("Installed repositories ({0}): {1}".format(
-                len(installed_repositories),
-                [(
-                    t['name'],
-                    t.get('changeset_revision')
-                ) for t in installed_repositories])
-            )
-            log.info("Skipped repositories ({0}): {1}".format(
-                len(skipped_repositories),
-                [(
-                    t['name'],
-                    t.get('changeset_revision')
-                ) for t in skipped_repositories])
-            )
-            log.info("Errored repositories ({0}): {1}".format(
-                len(errored_repositories),
-                [(
-                    t['name'],
-                    t.get('changeset_revision', "")
-                ) for t in errored_repositories])
-            )
-            log.info("All repositories have been installed.")
-            log.info("Total run time: {0}".format(dt.datetime.now() - installation_start))
-        InstallResults = namedtuple("InstallResults",
-                                    ["installed_repositories", "errored_repositories", "skipped_repositories"])
-        return InstallResults(installed_repositories=installed_repositories,
-                              skipped_repositories=skipped_repositories,
-                              errored_repositories=errored_repositories)
+                yield repository, "error"
+                continue
+            installed_revisions = installed_index.get(repository_key(complete_repo, check_revision=False), ())
+            if complete_repo['changeset_revision'] in installed_revisions:
+                yield complete_repo, "skip"
+            else:
+                yield complete_repo, "install"
 
     def update_repositories(self, repositories=None, log=None, **kwargs):
         if not repositories:  # Repositories None or empty list
             repositories = self.installed_repositories()
+            # Repositories installed outside of a tool panel section have no section information.
+            # Report them individually instead of aborting the update.
+            kwargs.setdefault('fail_fast', False)
         else:
             filtered_repos = self.filter_installed_repos(repositories, check_revision=False)
             if filtered_repos.not_installed_repos:
@@ -336,7 +449,6 @@ class InstallRepositoryManager(object):
             if log:
                 log.warning("Fetching test definition for tool '%s' failed", tool_id, exc_info=True)
             test_exceptions.append((tool_id, e))
-            Results = namedtuple("Results", ["tool_test_results", "tests_passed", "test_exceptions"])
             return Results(tool_test_results=tool_test_results,
                            tests_passed=tests_passed,
                            test_exceptions=test_exceptions)
@@ -371,13 +483,30 @@ class InstallRepositoryManager(object):
 
             executor.submit(run_test, test_index, test_id)
 
+    def _install_repository(self, repository, counter, total_num_repositories, installation_start, log):
+        if log:
+            log_repository_install_start(repository, counter=counter, installation_start=installation_start, log=log,
+                                         total_num_repositories=total_num_repositories)
+        start = monotonic()
+        try:
+            result = self.install_repository_revision(repository, log)
+        except Exception as e:
+            # Errors that install_repository_revision does not handle, like timing out while waiting
+            # for the install, are reported for this repository instead of aborting the other installs.
+            if log:
+                log_repository_install_error(repository, start, unicodify(e), log)
+            result = "error"
+        return result, monotonic() - start
+
     def install_repository_revision(self, repository, log):
-        default_err_msg = ('All repositories that you are attempting to install '
-                           'have been previously installed.')
-        start = dt.datetime.now()
+        start = monotonic()
         try:
-            repository['new_tool_panel_section_label'] = repository.pop('tool_panel_section_label')
-            response = self.tool_shed_client.install_repository_revision(**repository)
+            # Galaxy expects `new_tool_panel_section_label`. Build a new dict, so that
+            # `repository` is left untouched for logging, retries and the install results.
+            install_kwargs = dict((key, value) for key, value in repository.items() if key != 'tool_panel_section_label')
+            install_kwargs['new_tool_panel_section_label'] = repository.get('tool_panel_section_label')
+            response = self.tool_shed_client.install_repository_revision(**install_kwargs)
+            self._clear_installed_repositories()
             if isinstance(response, dict) and response.get('status', None) == 'ok':
                 # This rare case happens if a repository is already installed but
                 # was not recognised as such in the above check. In such a
@@ -394,16 +523,23 @@ class InstallRepositoryManager(object):
                     log=log)
             return "installed"
         except (ConnectionError, requests.exceptions.ConnectionError) as e:
-            if default_err_msg in unicodify(e):
+            error_msg = unicodify(e)
+            # requests' ConnectionError has no body or status code. Older bioblend
+            # releases have no status code either, there we look for it in the message.
+            error_body = getattr(e, 'body', None) or error_msg
+            status_code = getattr(e, 'status_code', None)
+            timed_out = status_code == 504 or (status_code is None and "504" in error_msg)
+            if ALREADY_INSTALLED_ERROR_MESSAGE in error_msg:
                 # THIS SHOULD NOT HAPPEN DUE TO THE CHECKS EARLIER
                 if log:
                     log.debug("\tRepository %s already installed (at revision %s)" %
                               (repository['name'], repository['changeset_revision']))
                 return "skipped"
-            elif "504" in unicodify(e) or 'Connection aborted' in unicodify(e):
+            elif timed_out or 'Connection aborted' in error_msg:
                 if log:
                     log.debug("Timeout during install of %s, extending wait to 1h", repository['name'])
                 success = self.wait_for_install(repository=repository, log=log, timeout=3600)
+                self._clear_installed_repositories()
                 if success:
                     if log:
                         log_repository_install_success(
@@ -415,14 +551,14 @@ class InstallRepositoryManager(object):
                     if log:
                         log_repository_install_error(
                             repository=repository,
-                            start=start, msg=e.body,
+                            start=start, msg=error_body,
                             log=log)
                     return "error"
             else:
                 if log:
                     log_repository_install_error(
                         repository=repository,
-                        start=start, msg=e.body,
+                        start=start, msg=error_body,
                         log=log)
                 return "error"
 
@@ -457,8 +593,10 @@ class InstallRepositoryManager(object):
             # Raise an exception and continue with the remaining repos.
             msg = "Multiple repositories for name '%s', owner '%s' found in non-terminal states. Please uninstall all non-terminal repositories."
             raise AssertionError(msg % (name, owner))
-        start = dt.datetime.now()
-        while (dt.datetime.now() - start) < dt.timedelta(seconds=timeout):
+        start = monotonic()
+        # Poll often at first, so quick installs are detected early, then back off.
+        sleep_time = WAIT_FOR_INSTALL_INITIAL_SLEEP
+        while monotonic() - start < timeout:
             try:
                 installed_repo = self.tool_shed_client.show_repository(installing_repo_id)
                 status = installed_repo['status']
@@ -466,25 +604,83 @@ class InstallRepositoryManager(object):
                     return True
                 elif status == 'Error':
                     return False
-                elif status in NON_TERMINAL_REPOSITORY_STATES:
-                    time.sleep(10)
-                else:
+                elif status not in NON_TERMINAL_REPOSITORY_STATES:
                     raise AssertionError("Repository name '%s', owner '%s' in unknown status '%s'" % (name, owner, status))
             except ConnectionError as e:
                 if log:
                     log.warning('Failed to get repositories list: %s', unicodify(e))
-                time.sleep(10)
+            time.sleep(sleep_time)
+            sleep_time = min(WAIT_FOR_INSTALL_MAX_SLEEP, sleep_time * 1.5)
         return False
 
 
+class ResultsJsonWriter(object):
+    """
+    Context manager that writes install results to `path` as JSON lines, flushing after each line,
+    so results can be followed while repositories are being installed.
+    Does nothing if `path` is None.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        if self.path:
+            self._file = open(self.path, 'w')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def write(self, event, repository, duration=None):
+        if not self._file:
+            return
+        json.dump({
+            'event': event,
+            'name': repository.get('name'),
+            'owner': repository.get('owner'),
+            'tool_shed_url': repository.get('tool_shed_url'),
+            'revision': repository.get('changeset_revision'),
+            'duration_s': duration,
+        }, self._file)
+        self._file.write('\n')
+        self._file.flush()
+
+
+class LazyRepositoryList(object):
+    """
+    Formats a list of repositories as ``(name, changeset_revision)`` tuples when converted to a string.
+    Pass it as a logging argument, so the list is only formatted if the message is emitted.
+    """
+
+    def __init__(self, repositories, default_revision=None):
+        self.repositories = repositories
+        self.default_revision = default_revision
+
+    def __str__(self):
+        return str([(
+            t['name'],
+            t.get('changeset_revision', self.default_revision)
+        ) for t in self.repositories])
+
+
+def elapsed_time(start):
+    """
+    Return the time elapsed since `start`, a value returned by `monotonic()`, as a timedelta.
+    """
+    return dt.timedelta(seconds=monotonic() - start)
+
+
 def log_repository_install_error(repository, start, msg, log):
     """
     Log failed repository installations. Return a dictionary with information
     """
-    end = dt.datetime.now()
     log.error(
         "\t* Error installing a repository (after %s seconds)! Name: %s," "owner: %s, ""revision: %s, error: %s",
-        str(end - start),
+        str(elapsed_time(start)),
         repository.get('name', ""),
         repository.get('owner', ""),
         repository.get('changeset_revision', ""),
@@ -496,11 +692,10 @@ def log_repository_install_success(repository, start, log):
     Log successful repository installation.
     Repositories that finish in error still count as successful installs currently.
     """
-    end = dt.datetime.now()
     log.debug(
         "\trepository %s installed successfully (in %s) at revision %s" % (
             repository['name'],
-            str(end - start),
+            str(elapsed_time(start)),
             repository['changeset_revision']
         )
     )
@@ -526,11 +721,41 @@ def log_repository_install_start(repository, counter, total_num_repositories, in
             repository['owner'],
             repository['tool_panel_section_id'] or repository['tool_panel_section_label'],
             repository['changeset_revision'],
-            dt.datetime.now() - installation_start
+            elapsed_time(installation_start)
         )
     )
 
 
+def unique_repositories(repositories, default_toolshed):
+    """
+    Remove repeated entries (same name, owner, tool shed and changeset revision)
+    from a flattened list of repositories, keeping the first occurrence.
+    Repositories without a tool shed url are assumed to come from `default_toolshed`.
+    """
+    seen = set()
+    unique = []
+    for repo in repositories:
+        key_info = repo if 'tool_shed_url' in repo else dict(repo, tool_shed_url=default_toolshed)
+        key = repository_key(key_info, check_revision=True)
+        if key not in seen:
+            seen.add(key)
+            unique.append(repo)
+    return unique
+
+
+def revisions_to_prefetch(repositories, default_toolshed, force_latest_revision):
+    """
+    Yield the ``(tool_shed_url, name, owner)`` keys of the repositories whose installable revisions
+    will be looked up. Incomplete entries are skipped here, they are reported when they are prepared.
+    """
+    for repo in repositories:
+        tool_shed_url = repo.get('tool_shed_url', default_toolshed)
+        if 'name' not in repo or 'owner' not in repo or not isinstance(tool_shed_url, six.string_types):
+            continue
+        if force_latest_revision or repo.get('changeset_revision') is None:
+            yield format_tool_shed_url(tool_shed_url), repo['name'], repo['owner']
+
+
 def args_to_repos(args):
     if args.tool_list_file:
         tool_list = load_yaml_file(args.tool_list_file)
@@ -559,6 +784,8 @@ def main():
     log = setup_global_logger(name=__name__, log_file=args.log_file)
     gi = get_galaxy_connection(args, file=args.tool_list_file, log=log, login_required=True)
     install_repository_manager = InstallRepositoryManager(gi)
+    if args.action in ("install", "update") and not args.skip_shed_cache:
+        enable_revision_cache(ttl=args.shed_cache_ttl)
 
     repos = args_to_repos(args)
 
@@ -577,7 +804,9 @@ def main():
                                                                                                             False),
         default_install_resolver_dependencies=tool_list.get("install_resolver_dependencies") or getattr(args,
                                                                                                         "install_resolver_dependencies",
-                                                                                                        False))
+                                                                                                        False),
+        parallel_installs=args.parallel_installs,
+        results_json=args.results_json)
 
     # Start installing/updating and store the results in install_results.
     # Or do testing if the action is `test`
@@ -33,6 +33,10 @@ def parser():
         test_json="tool_test_output.json",
         test_existing=False,
         parallel_tests=1,
+        parallel_installs=1,
+        shed_cache_ttl=3600,
+        skip_shed_cache=False,
+        results_json=None,
     )
 
     # SUBPARSERS
@@ -176,6 +180,34 @@ def parser():
             type=int,
             help="Specify the maximum number of tests that will be run in parallel."
         )
+        command_parser.add_argument(
+            "--parallel_installs",
+            dest="parallel_installs",
+            default=1,
+            type=int,
+            help="Specify the maximum number of repositories that will be installed in parallel."
+        )
+        command_parser.add_argument(
+            "--shed_cache_ttl",
+            dest="shed_cache_ttl",
+            default=3600,
+            type=int,
+            help="Number of seconds the installable revisions fetched from the Tool Shed are cached on disk "
+                 "(in ~/.cache/ephemeris). Cached revisions are reused by later runs."
+        )
+        command_parser.add_argument(
+            "--skip_shed_cache",
+            action="store_true",
+            dest="skip_shed_cache",
+            help="Do not read or write the on-disk cache of installable revisions, always query the Tool Shed."
+        )
+        command_parser.add_argument(
+            "--results_json",
+            dest="results_json",
+            default=None,
+            help="Write the result of each repository (installed, skipped or errored) to this file "
+                 "as soon as it is known, one JSON object per line."
+        )
 
     # OPTIONS UNIQUE TO INSTALL
 
@@ -0,0 +1,43 @@
+"""
+Concurrent queries to the tool shed, using asyncio and aiohttp.
+Only imported by `shed_tools_methods.prefetch_installable_revisions` when aiohttp is available.
+"""
+import asyncio
+
+import aiohttp
+
+from .shed_tools_methods import installable_revisions_url
+
+MAX_CONCURRENT_REQUESTS = 16
+# Seconds each request may take, so an unresponsive tool shed cannot stall the install.
+REQUEST_TIMEOUT = 60
+
+
+async def _fetch_installable_revisions(session, semaphore, tool_shed_url, name, owner):
+    async with semaphore:
+        async with session.get(installable_revisions_url(tool_shed_url), params={'name': name, 'owner': owner}) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+
+async def _fetch_all_installable_revisions(keys, max_concurrent_requests):
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
+    # trust_env makes the proxy settings apply, as they do for the requests session used otherwise.
+    async with aiohttp.ClientSession(trust_env=True, timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)) as session:
+        return await asyncio.gather(
+            *[_fetch_installable_revisions(session, semaphore, *key) for key in keys],
+            return_exceptions=True
+        )
+
+
+def fetch_installable_revisions(keys, max_concurrent_requests=MAX_CONCURRENT_REQUESTS):
+    """
+    Query the installable revisions of a list of ``(tool_shed_url, name, owner)`` keys concurrently.
+    Return a dict mapping each key to its list of revisions, or to the exception raised by its request.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        results = loop.run_until_complete(_fetch_all_installable_revisions(keys, max_concurrent_requests))
+    finally:
+        loop.close()
+    return dict(zip(keys, results))
@@ -1,4 +1,11 @@
-from bioblend.toolshed import ToolShedInstance
+import json
+import os
+import time
+
+import requests
+import six
+
+from . import __version__
 
 
 VALID_KEYS = [
@@ -13,6 +20,108 @@ VALID_KEYS = [
     "install_tool_dependencies"
 ]
 
+DEFAULT_REVISION_CACHE_TTL = 3600
+
+# Maps tool shed urls, formatted or not, to their formatted version.
+_FORMATTED_TOOL_SHED_URLS = {}
+# Caches for tool shed lookups, so each repository is only queried once per run.
+_INSTALLABLE_REVISIONS = {}
+# Shared by all tool shed queries, so the connection to each tool shed is kept alive between requests.
+_SESSION = requests.Session()
+# Optional on-disk cache shared between runs, see `enable_revision_cache`.
+_REVISION_CACHE = None
+
+
+class RevisionCache(object):
+    """
+    A JSON file that stores the installable revisions of repositories, together with the
+    tool shed url, the time of the query and the ephemeris version that made it.
+    Entries older than `ttl` seconds are ignored.
+    """
+
+    def __init__(self, path, ttl=DEFAULT_REVISION_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._entries = self._load()
+        self._modified = False
+
+    @staticmethod
+    def _key(tool_shed_url, name, owner):
+        return "{0}|{1}|{2}".format(tool_shed_url, name, owner)
+
+    def _load(self):
+        try:
+            with open(self.path) as cache_file:
+                entries = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            # Missing or corrupt cache files are treated as empty.
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        # Entries that were not written by `set` are dropped, so they are cache misses.
+        return dict((key, entry) for key, entry in entries.items() if self._valid_entry(entry))
+
+    @staticmethod
+    def _valid_entry(entry):
+        return (isinstance(entry, dict)
+                and isinstance(entry.get('time'), (float,) + six.integer_types)
+                and not isinstance(entry['time'], bool)
+                and isinstance(entry.get('revisions'), list))
+
+    def get(self, tool_shed_url, name, owner):
+        """Return the cached revisions as a tuple, or None if there is no valid entry."""
+        entry = self._entries.get(self._key(tool_shed_url, name, owner))
+        if entry is None or time.time() - entry['time'] > self.ttl:
+            return None
+        return tuple(entry['revisions'])
+
+    def set(self, tool_shed_url, name, owner, revisions, save=True):
+        self._entries[self._key(tool_shed_url, name, owner)] = {
+            'tool_shed_url': tool_shed_url,
+            'revisions': list(revisions),
+            'time': time.time(),
+            'ephemeris_version': __version__,
+        }
+        self._modified = True
+        if save:
+            self.save()
+
+    def save(self):
+        """Write the cache file, dropping entries older than `ttl`. Does nothing if no entry was added."""
+        if not self._modified:
+            return
+        now = time.time()
+        self._entries = dict((key, entry) for key, entry in self._entries.items() if now - entry['time'] <= self.ttl)
+        cache_dir = os.path.dirname(self.path)
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = "{0}.{1}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, 'w') as cache_file:
+            json.dump(self._entries, cache_file)
+        os.rename(tmp_path, self.path)
+        self._modified = False
+
+
+def default_revision_cache_path():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'ephemeris', 'installable_revisions.json')
+
+
+def enable_revision_cache(path=None, ttl=DEFAULT_REVISION_CACHE_TTL):
+    """
+    Store installable revisions on disk, so that subsequent runs do not need to query the tool shed
+    for repositories that were looked up less than `ttl` seconds ago.
+    """
+    global _REVISION_CACHE
+    _REVISION_CACHE = RevisionCache(path or default_revision_cache_path(), ttl=ttl)
+    return _REVISION_CACHE
+
+
+def save_revision_cache():
+    """Write the revisions fetched so far to the on-disk cache, if `enable_revision_cache` was called."""
+    if _REVISION_CACHE:
+        _REVISION_CACHE.save()
+
 
 def complete_repo_information(tool,
                               default_toolshed_url,
@@ -27,10 +136,10 @@ def complete_repo_information(tool,
     repo['owner'] = tool['owner']
     repo['tool_panel_section_id'] = tool.get('tool_panel_section_id')
     repo['tool_panel_section_label'] = tool.get('tool_panel_section_label')
-    if require_tool_panel_info and repo['tool_panel_section_id'] is None and repo[
-            'tool_panel_section_label'] is None and 'data_manager' not in repo.get('name'):
-        raise KeyError("Either tool_panel_section_id or tool_panel_section_name must be defined for tool '{0}'.".format(
-            repo.get('name')))
+    if require_tool_panel_info:
+        tool_panel_error = tool_panel_info_error(repo)
+        if tool_panel_error:
+            raise KeyError(tool_panel_error)
     repo['tool_shed_url'] = format_tool_shed_url(tool.get('tool_shed_url', default_toolshed_url))
     repo['changeset_revision'] = tool.get('changeset_revision')
     repo = get_changeset_revisions(repo, force_latest_revision)
@@ -42,12 +151,57 @@ def complete_repo_information(tool,
     return repo
 
 
+def validate_repositories(repositories, require_tool_panel_info):
+    """
+    Check a list of repositories for missing information, without connecting to a tool shed.
+    Return a list of problems, which is empty if all repositories are valid.
+    """
+    problems = []
+    for index, repo in enumerate(repositories):
+        missing_keys = [key for key in ('name', 'owner') if not repo.get(key)]
+        if missing_keys:
+            problems.append("Repository {0} ('{1}') is missing required key(s): {2}.".format(
+                index, repo.get('name', ''), ', '.join(missing_keys)))
+            continue
+        if 'tool_shed_url' in repo and not isinstance(repo['tool_shed_url'], six.string_types):
+            problems.append("Repository {0} ('{1}') has an invalid tool_shed_url: {2!r}.".format(
+                index, repo['name'], repo['tool_shed_url']))
+        if require_tool_panel_info:
+            tool_panel_error = tool_panel_info_error(repo)
+            if tool_panel_error:
+                problems.append(tool_panel_error)
+    return problems
+
+
+def tool_panel_info_error(repo):
+    """
+    Return why `repo` cannot be installed into the tool panel, or None if it can.
+    Data managers are not installed into a tool panel section, so they need no section information.
+    """
+    if repo.get('tool_panel_section_id') is None and repo.get(
+            'tool_panel_section_label') is None and 'data_manager' not in repo.get('name'):
+        return "Either tool_panel_section_id or tool_panel_section_name must be defined for tool '{0}'.".format(
+            repo.get('name'))
+    return None
+
+
 def format_tool_shed_url(tool_shed_url):
+    """
+    Return `tool_shed_url` with a scheme and a trailing slash.
+    Results are memoized, and equal results are the same string object,
+    so comparing formatted urls is usually an identity check.
+    """
+    try:
+        return _FORMATTED_TOOL_SHED_URLS[tool_shed_url]
+    except KeyError:
+        pass
     formatted_tool_shed_url = tool_shed_url
     if not formatted_tool_shed_url.endswith('/'):
         formatted_tool_shed_url += '/'
     if not formatted_tool_shed_url.startswith('http'):
         formatted_tool_shed_url = 'https://' + formatted_tool_shed_url
+    formatted_tool_shed_url = _FORMATTED_TOOL_SHED_URLS.setdefault(formatted_tool_shed_url, formatted_tool_shed_url)
+    _FORMATTED_TOOL_SHED_URLS[tool_shed_url] = formatted_tool_shed_url
     return formatted_tool_shed_url
 
 
@@ -60,10 +214,10 @@ def get_changeset_revisions(repository, force_latest_revision=False):
     """
     # Do not connect to the internet when not necessary
     if repository.get('changeset_revision') is None or force_latest_revision:
-        ts = ToolShedInstance(url=repository['tool_shed_url'])
         # Get the set revision or set it to the latest installable revision
-        installable_revisions = ts.repositories.get_ordered_installable_revisions(repository['name'],
-                                                                                  repository['owner'])
+        installable_revisions = get_installable_revisions(repository['tool_shed_url'],
+                                                          repository['name'],
+                                                          repository['owner'])
         if not installable_revisions:  #
             raise LookupError("Repo does not exist in tool shed: {0}".format(repository))
         repository['changeset_revision'] = installable_revisions[-1]
@@ -71,6 +225,65 @@ def get_changeset_revisions(repository, force_latest_revision=False):
     return repository
 
 
+def installable_revisions_url(tool_shed_url):
+    return tool_shed_url.rstrip('/') + '/api/repositories/get_ordered_installable_revisions'
+
+
+def _query_installable_revisions(tool_shed_url, name, owner):
+    url = installable_revisions_url(tool_shed_url)
+    response = _SESSION.get(url, params={'name': name, 'owner': owner})
+    response.raise_for_status()
+    return response.json()
+
+
+def get_installable_revisions(tool_shed_url, name, owner):
+    """
+    Return a tuple of the installable revisions of a repository, ordered from oldest to newest.
+    The tool shed is only queried the first time a repository is requested,
+    so listing several revisions of the same repository costs a single request.
+    If `enable_revision_cache` was called, revisions are also read from the on-disk cache,
+    and added to it when `save_revision_cache` is called.
+    """
+    key = (tool_shed_url, name, owner)
+    if key not in _INSTALLABLE_REVISIONS:
+        revisions = _REVISION_CACHE.get(*key) if _REVISION_CACHE else None
+        if revisions is None:
+            revisions = tuple(_query_installable_revisions(tool_shed_url, name, owner) or ())
+            # Repositories that were not found are not stored on disk, they may be uploaded later on.
+            if _REVISION_CACHE and revisions:
+                # Written to disk by `save_revision_cache`, not once per repository.
+                _REVISION_CACHE.set(tool_shed_url, name, owner, revisions, save=False)
+        _INSTALLABLE_REVISIONS[key] = revisions
+    return _INSTALLABLE_REVISIONS[key]
+
+
+def prefetch_installable_revisions(keys):
+    """
+    Fetch the installable revisions of all ``(tool_shed_url, name, owner)`` keys
+    that are not cached yet with concurrent requests, so that `get_installable_revisions`
+    does not need to query the tool shed for them one by one.
+    This requires aiohttp (and Python 3), installed with the ``async`` extra
+    (``pip install ephemeris[async]``). Without it nothing is fetched.
+    Failed requests are not cached, so `get_installable_revisions` retries and reports them.
+    """
+    keys = [key for key in set(keys)
+            if key not in _INSTALLABLE_REVISIONS and not (_REVISION_CACHE and _REVISION_CACHE.get(*key) is not None)]
+    if not keys:
+        return
+    try:
+        from .shed_tools_async import fetch_installable_revisions
+    except (ImportError, SyntaxError):  # aiohttp is not installed, or Python 2
+        return
+    for key, revisions in fetch_installable_revisions(keys).items():
+        if isinstance(revisions, Exception):
+            continue
+        revisions = tuple(revisions or ())
+        if _REVISION_CACHE and revisions:
+            _REVISION_CACHE.set(key[0], key[1], key[2], revisions, save=False)
+        _INSTALLABLE_REVISIONS[key] = revisions
+    save_revision_cache()
+
+
 def flatten_repo_info(repositories):
     """
     Flatten the dict containing info about what tools to install.
@@ -85,25 +298,19 @@ def flatten_repo_info(repositories):
              that if an input element contained `revisions` key with multiple
              values, those will be returned as separate list items.
     """
-
     flattened_list = []
     for repo_info in repositories:
         new_repo_info = dict()
         for key, value in repo_info.items():
             if key in VALID_KEYS:
                 new_repo_info[key] = value
-        if 'revisions' in repo_info:
-            revisions = repo_info.get('revisions', [])
-            if not revisions:  # Revisions are empty list or None
-                flattened_list.append(new_repo_info)
-            else:
-                for revision in revisions:
-                    # A new dictionary must be created, otherwise there will
-                    # be aliasing of dictionaries. Which leads to multiple
-                    # repos with the same revision in the end result.
-                    new_revision_dict = dict(**new_repo_info)
-                    new_revision_dict['changeset_revision'] = revision
-                    flattened_list.append(new_revision_dict)
-        else:  # Revision was not defined at all
+        revisions = repo_info.get('revisions')
+        if not revisions:  # Revisions were not defined at all, or are empty list or None
             flattened_list.append(new_repo_info)
+        else:
+            for revision in revisions:
+                # A new dictionary must be created, otherwise there will
+                # be aliasing of dictionaries. Which leads to multiple
+                # repos with the same revision in the end result.
+                flattened_list.append(dict(new_repo_info, changeset_revision=revision))
     return flattened_list
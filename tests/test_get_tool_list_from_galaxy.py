@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+from ephemeris import get_tool_list_from_galaxy
+from ephemeris.get_tool_list_from_galaxy import GiToToolYaml, repository_key, the_same_repository
+
+
+def test_the_same_repository():
+    installed_repo = dict(name="bwa",
+                          owner="devteam",
+                          tool_shed="toolshed.g2.bx.psu.edu",
+                          changeset_revision="1")
+    repo = dict(name="bwa",
+                owner="devteam",
+                tool_shed_url="https://toolshed.g2.bx.psu.edu/",
+                changeset_revision="1")
+    assert the_same_repository(installed_repo, repo)
+    assert repository_key(installed_repo) == repository_key(repo)
+    repo['changeset_revision'] = "2"
+    assert not the_same_repository(installed_repo, repo)
+    assert the_same_repository(installed_repo, repo, check_revision=False)
+    repo['tool_shed_url'] = "https://testtoolshed.g2.bx.psu.edu/"
+    assert not the_same_repository(installed_repo, repo, check_revision=False)
+
+
+def test_the_same_repository_http_tool_shed():
+    installed_repo = dict(name="bwa",
+                          owner="devteam",
+                          tool_shed="localhost:9009",
+                          changeset_revision="1")
+    repo = dict(name="bwa",
+                owner="devteam",
+                tool_shed_url="http://localhost:9009/",
+                changeset_revision="1")
+    assert the_same_repository(installed_repo, repo)
+    assert the_same_repository(installed_repo, dict(repo, tool_shed_url="http://localhost:9009"), check_revision=False)
+
+
+def test_repository_list_all_tools(monkeypatch):
+    def tool(name, section_id):
+        return dict(model_class="Tool",
+                    panel_section_id=section_id,
+                    panel_section_name=section_id.upper(),
+                    tool_shed_repository=dict(name=name, owner="devteam", tool_shed="toolshed.g2.bx.psu.edu", changeset_revision="1"))
+
+    class ToolShedClient(object):
+        def __init__(self, gi):
+            pass
+
+        def get_repositories(self):
+            repository = dict(owner="devteam", tool_shed="toolshed.g2.bx.psu.edu", changeset_revision="2", deleted=False)
+            return [dict(repository, name="bwa"), dict(repository, name="bowtie2"), dict(repository, name="deleted", deleted=True)]
+
+    monkeypatch.setattr(get_tool_list_from_galaxy, "get_tool_panel", lambda gi: [tool("bwa", "mapping"), tool("bwa", "alignment")])
+    monkeypatch.setattr(get_tool_list_from_galaxy, "ToolShedClient", ToolShedClient)
+    repositories = GiToToolYaml(gi=None, get_all_tools=True).repository_list
+    # The first repository with panel information wins, repositories without tools in the panel have no section.
+    assert [(r["name"], r["revisions"], r["tool_panel_section_id"]) for r in repositories[2:]] == [
+        ("bwa", ["2"], "mapping"),
+        ("bowtie2", ["2"], None),
+    ]
@@ -24,12 +24,14 @@ class TestMiscellaneous(object):
         container = start_container
         irm = InstallRepositoryManager(container.gi)
         caplog.set_level(logging.WARNING)
-        irm.install_repositories([
-            dict(name="bwa",
-                 owner="devteam",
-                 tool_panel_section_name="NGS: Alignment",
-                 sesame_ouvre_toi="Invalid key")
-        ], log=logging.getLogger())
+        # tool_panel_section_name is not a valid key either, so the section is missing.
+        with pytest.raises(ValueError):
+            irm.install_repositories([
+                dict(name="bwa",
+                     owner="devteam",
+                     tool_panel_section_name="NGS: Alignment",
+                     sesame_ouvre_toi="Invalid key")
+            ], log=logging.getLogger())
         assert "'sesame_ouvre_toi' not a valid key. Will be skipped during parsing" in caplog.text
 
     @pytest.mark.parametrize("parallel_tests", [1, 2])
@@ -1,6 +1,19 @@
 #!/usr/bin/env python
+import json
+import sys
+import threading
+import types
 
-from ephemeris.shed_tools_methods import flatten_repo_info
+import pytest
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from ephemeris import shed_tools_methods
+from ephemeris.shed_tools_methods import (
+    flatten_repo_info,
+    format_tool_shed_url,
+    get_changeset_revisions,
+    validate_repositories,
+)
 
 
 def test_flatten_repo_info():
@@ -30,6 +43,14 @@ def test_flatten_repo_info():
     ])
 
 
+def test_flatten_repo_info_no_aliasing():
+    test_repositories = [dict(name="bwa", owner="devteam", revisions=["1", "2"])]
+    first, second = flatten_repo_info(test_repositories)
+    assert first is not second
+    assert (first['changeset_revision'], second['changeset_revision']) == ("1", "2")
+    assert test_repositories[0]['revisions'] == ["1", "2"]
+
+
 def test_flatten_repo_info_invalid_key():
     test_repositories = [
         dict(name="bwa",
@@ -42,3 +63,164 @@ def test_flatten_repo_info_invalid_key():
 
     assert "sesame_ouvre_toi" not in flattened_repos[0].keys()
     assert "tool_shed_url" in flattened_repos[0].keys()
+
+
+def test_get_changeset_revisions_queries_tool_shed_once(monkeypatch):
+    requested = []
+
+    def query_installable_revisions(tool_shed_url, name, owner):
+        requested.append((name, owner))
+        return ["1", "2"]
+
+    monkeypatch.setattr(shed_tools_methods, "_INSTALLABLE_REVISIONS", {})
+    monkeypatch.setattr(shed_tools_methods, "_query_installable_revisions", query_installable_revisions)
+    for _ in range(2):
+        repo = get_changeset_revisions(dict(name="bwa",
+                                            owner="devteam",
+                                            tool_shed_url="https://toolshed.g2.bx.psu.edu/"))
+        assert repo['changeset_revision'] == "2"
+    assert requested == [("bwa", "devteam")]
+
+
+def test_revision_cache(tmpdir):
+    cache_path = str(tmpdir.join("cache", "installable_revisions.json"))
+    cache = shed_tools_methods.RevisionCache(cache_path, ttl=3600)
+    assert cache.get("https://toolshed.g2.bx.psu.edu/", "bwa", "devteam") is None
+    cache.set("https://toolshed.g2.bx.psu.edu/", "bwa", "devteam", ("1", "2"))
+    # A new run reads the revisions back from disk
+    cache = shed_tools_methods.RevisionCache(cache_path, ttl=3600)
+    assert cache.get("https://toolshed.g2.bx.psu.edu/", "bwa", "devteam") == ("1", "2")
+    assert cache.get("https://toolshed.g2.bx.psu.edu/", "bowtie2", "devteam") is None
+    cache.ttl = -1
+    assert cache.get("https://toolshed.g2.bx.psu.edu/", "bwa", "devteam") is None
+    # Expired entries are dropped when saving
+    cache.set("https://toolshed.g2.bx.psu.edu/", "bowtie2", "devteam", ("3",), save=False)
+    cache.ttl = 3600
+    cache._entries[cache._key("https://toolshed.g2.bx.psu.edu/", "bwa", "devteam")]['time'] -= 7200
+    cache.save()
+    cache = shed_tools_methods.RevisionCache(cache_path, ttl=3600)
+    assert cache.get("https://toolshed.g2.bx.psu.edu/", "bowtie2", "devteam") == ("3",)
+    assert len(cache._entries) == 1
+
+
+@pytest.mark.parametrize("content", [
+    [],
+    {"https://toolshed.g2.bx.psu.edu/|bwa|devteam": ["1"]},
+    {"https://toolshed.g2.bx.psu.edu/|bwa|devteam": {"revisions": ["1"]}},
+    {"https://toolshed.g2.bx.psu.edu/|bwa|devteam": {"time": "now", "revisions": ["1"]}},
+    {"https://toolshed.g2.bx.psu.edu/|bwa|devteam": {"time": 0, "revisions": "1"}},
+])
+def test_revision_cache_invalid_file(tmpdir, content):
+    cache_path = tmpdir.join("installable_revisions.json")
+    cache_path.write(json.dumps(content))
+    cache = shed_tools_methods.RevisionCache(str(cache_path), ttl=float("inf"))
+    assert cache.get("https://toolshed.g2.bx.psu.edu/", "bwa", "devteam") is None
+    cache.set("https://toolshed.g2.bx.psu.edu/", "bwa", "devteam", ("1",))
+    assert shed_tools_methods.RevisionCache(str(cache_path)).get("https://toolshed.g2.bx.psu.edu/", "bwa", "devteam") == ("1",)
+
+
+def test_format_tool_shed_url():
+    formatted_url = format_tool_shed_url("toolshed.g2.bx.psu.edu")
+    assert formatted_url == "https://toolshed.g2.bx.psu.edu/"
+    assert format_tool_shed_url("https://toolshed.g2.bx.psu.edu") is formatted_url
+    assert format_tool_shed_url(formatted_url) is formatted_url
+    assert format_tool_shed_url("http://localhost:9009") == "http://localhost:9009/"
+
+
+def test_validate_repositories():
+    test_repositories = [
+        dict(name="bwa", owner="devteam", tool_panel_section_label="NGS: Alignment"),
+        dict(name="bowtie2", tool_panel_section_label="NGS: Alignment"),
+        dict(name="samtools", owner="devteam"),
+        dict(name="data_manager_bwa_mem_index_builder", owner="devteam"),
+        dict(name="hisat2", owner="devteam", tool_shed_url=None, tool_panel_section_label="NGS: Alignment"),
+    ]
+    problems = validate_repositories(test_repositories, require_tool_panel_info=True)
+    assert len(problems) == 3
+    assert "owner" in problems[0]
+    assert "samtools" in problems[1]
+    assert "tool_shed_url" in problems[2]
+    assert len(validate_repositories(test_repositories, require_tool_panel_info=False)) == 2
+
+
+def test_get_changeset_revisions_pinned_revision_is_not_queried(monkeypatch):
+    def query_installable_revisions(tool_shed_url, name, owner):
+        raise AssertionError("The tool shed should not be queried for a pinned revision")
+
+    monkeypatch.setattr(shed_tools_methods, "_INSTALLABLE_REVISIONS", {})
+    monkeypatch.setattr(shed_tools_methods, "_query_installable_revisions", query_installable_revisions)
+    repo = get_changeset_revisions(dict(name="bwa",
+                                        owner="devteam",
+                                        tool_shed_url="https://toolshed.g2.bx.psu.edu/",
+                                        changeset_revision="1"))
+    assert repo['changeset_revision'] == "1"
+
+
+def test_prefetch_installable_revisions_skips_failed_requests(monkeypatch):
+    requested = []
+
+    def fetch_installable_revisions(keys):
+        requested.extend(keys)
+        return dict((key, ValueError("Tool shed error") if key[2] == "missing" else ["1", "2"]) for key in keys)
+
+    shed_tools_async = types.ModuleType("ephemeris.shed_tools_async")
+    shed_tools_async.fetch_installable_revisions = fetch_installable_revisions
+    monkeypatch.setitem(sys.modules, "ephemeris.shed_tools_async", shed_tools_async)
+    cached_key = ("https://toolshed.g2.bx.psu.edu/", "bowtie2", "devteam")
+    monkeypatch.setattr(shed_tools_methods, "_INSTALLABLE_REVISIONS", {cached_key: ("3",)})
+    shed_tools_methods.prefetch_installable_revisions([
+        ("https://toolshed.g2.bx.psu.edu/", "bwa", "devteam"),
+        ("https://toolshed.g2.bx.psu.edu/", "bwa", "devteam"),
+        ("https://toolshed.g2.bx.psu.edu/", "bwa", "missing"),
+        cached_key,
+    ])
+    assert sorted(requested) == [("https://toolshed.g2.bx.psu.edu/", "bwa", "devteam"),
+                                 ("https://toolshed.g2.bx.psu.edu/", "bwa", "missing")]
+    assert shed_tools_methods._INSTALLABLE_REVISIONS == {
+        ("https://toolshed.g2.bx.psu.edu/", "bwa", "devteam"): ("1", "2"),
+        cached_key: ("3",),
+    }
+
+
+def test_prefetch_installable_revisions_local_tool_shed(monkeypatch):
+    pytest.importorskip("aiohttp")
+
+    class ToolShedHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if "owner=missing" in self.path:
+                self.send_response(500)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps(["1", "2"]).encode())
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), ToolShedHandler)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    try:
+        tool_shed_url = "http://127.0.0.1:{0}/".format(server.server_port)
+        monkeypatch.setattr(shed_tools_methods, "_INSTALLABLE_REVISIONS", {})
+        shed_tools_methods.prefetch_installable_revisions([(tool_shed_url, "bwa", "devteam"),
+                                                           (tool_shed_url, "bwa", "missing")])
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert shed_tools_methods._INSTALLABLE_REVISIONS == {(tool_shed_url, "bwa", "devteam"): ("1", "2")}
+
+
+def test_revision_cache_saved_once(tmpdir, monkeypatch):
+    cache_path = str(tmpdir.join("installable_revisions.json"))
+    monkeypatch.setattr(shed_tools_methods, "_INSTALLABLE_REVISIONS", {})
+    monkeypatch.setattr(shed_tools_methods, "_REVISION_CACHE", shed_tools_methods.RevisionCache(cache_path))
+    monkeypatch.setattr(shed_tools_methods, "_query_installable_revisions", lambda tool_shed_url, name, owner: ["1"])
+    for owner in ("devteam", "iuc"):
+        shed_tools_methods.get_installable_revisions("https://toolshed.g2.bx.psu.edu/", "bwa", owner)
+    assert not tmpdir.join("installable_revisions.json").check()
+    shed_tools_methods.save_revision_cache()
+    assert len(json.loads(tmpdir.join("installable_revisions.json").read())) == 2
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+"""Tests for shed_tools that do not need a Galaxy instance."""
+import json
+import logging
+import threading
+
+import pytest
+import requests
+from bioblend import ConnectionError
+
+from ephemeris import shed_tools_methods
+from ephemeris.shed_tools import (
+    ALREADY_INSTALLED_ERROR_MESSAGE,
+    InstallRepositoryManager,
+    ResultsJsonWriter,
+    unique_repositories,
+)
+
+TOOL_SHED_URL = "https://toolshed.g2.bx.psu.edu/"
+
+
+def installed_repository(name, revisions):
+    return dict(name=name,
+                owner="devteam",
+                tool_shed_url="toolshed.g2.bx.psu.edu",
+                tool_panel_section_label="NGS: Alignment",
+                revisions=revisions)
+
+
+def install_repository_manager(installed_repositories=()):
+    """An InstallRepositoryManager with the given installed repositories, that does not connect to Galaxy."""
+    irm = InstallRepositoryManager.__new__(InstallRepositoryManager)
+    irm._installed_repositories = list(installed_repositories)
+    irm._installed_index = None
+    return irm
+
+
+def test_results_json_writer(tmpdir):
+    results_json = tmpdir.join("results.jsonl")
+    repository = dict(name="bwa", owner="devteam", tool_shed_url=TOOL_SHED_URL, changeset_revision="1")
+    with ResultsJsonWriter(str(results_json)) as results_writer:
+        results_writer.write("installed", repository, 1.5)
+        # Each line is flushed as soon as it is written
+        assert json.loads(results_json.read()) == {
+            "event": "installed",
+            "name": "bwa",
+            "owner": "devteam",
+            "tool_shed_url": TOOL_SHED_URL,
+            "revision": "1",
+            "duration_s": 1.5,
+        }
+        results_writer.write("skipped", dict(repository, changeset_revision="2"))
+        assert [json.loads(line)["event"] for line in results_json.readlines()] == ["installed", "skipped"]
+    assert json.loads(results_json.readlines()[1])["duration_s"] is None
+
+
+def test_results_json_writer_without_path():
+    with ResultsJsonWriter(None) as results_writer:
+        results_writer.write("installed", dict(name="bwa"))
+
+
+def test_install_results_written_while_preparing(tmpdir):
+    results_json = tmpdir.join("results.jsonl")
+    irm = install_repository_manager()
+    irm.install_repository_revision = lambda repository, log: "installed"
+    first_result_written = threading.Event()
+
+    def prepare_repositories(repositories, **kwargs):
+        yield dict(name="bwa", owner="devteam", tool_shed_url=TOOL_SHED_URL, changeset_revision="1"), "install"
+        # The next repository is still being prepared, the first install must already be in the results file.
+        for _ in range(100):
+            if results_json.check() and results_json.read():
+                first_result_written.set()
+                break
+            first_result_written.wait(0.05)
+        yield dict(name="bowtie2", owner="devteam", tool_shed_url=TOOL_SHED_URL, changeset_revision="1"), "skip"
+
+    irm._prepare_repositories = prepare_repositories
+    install_results = irm.install_repositories([dict(name="bwa", owner="devteam", tool_panel_section_label="NGS: Alignment", revisions=["1"])],
+                                               results_json=str(results_json))
+    assert first_result_written.is_set()
+    assert [r["name"] for r in install_results.installed_repositories] == ["bwa"]
+    assert [r["name"] for r in install_results.skipped_repositories] == ["bowtie2"]
+    assert [json.loads(line)["event"] for line in results_json.readlines()] == ["installed", "skipped"]
+
+
+def test_install_error_recorded(tmpdir):
+    results_json = tmpdir.join("results.jsonl")
+    irm = install_repository_manager()
+
+    def install_repository_revision(repository, log):
+        if repository['name'] == "bwa":
+            raise AssertionError("Repository bwa did not finish installing in time")
+        return "installed"
+
+    irm.install_repository_revision = install_repository_revision
+    prepared = [dict(name=name, owner="devteam", tool_shed_url=TOOL_SHED_URL, changeset_revision="1",
+                     tool_panel_section_id=None, tool_panel_section_label="NGS: Alignment") for name in ("bwa", "bowtie2")]
+    irm._prepare_repositories = lambda repositories, **kwargs: ((repository, "install") for repository in prepared)
+    install_results = irm.install_repositories([dict(name="bwa", owner="devteam", tool_panel_section_label="NGS: Alignment", revisions=["1"])],
+                                               log=logging.getLogger(__name__),
+                                               results_json=str(results_json))
+    assert [r["name"] for r in install_results.errored_repositories] == ["bwa"]
+    assert [r["name"] for r in install_results.installed_repositories] == ["bowtie2"]
+    assert sorted((json.loads(line)["name"], json.loads(line)["event"]) for line in results_json.readlines()) == [
+        ("bowtie2", "installed"),
+        ("bwa", "errored"),
+    ]
+
+
+def test_unique_repositories():
+    repositories = [
+        dict(name="bwa", owner="devteam", tool_shed_url=TOOL_SHED_URL, changeset_revision="1",
+             tool_panel_section_label="NGS: Alignment"),
+        dict(name="bwa", owner="devteam", tool_shed_url=TOOL_SHED_URL, changeset_revision="1",
+             tool_panel_section_label="NGS: Mapping"),
+        dict(name="bwa", owner="devteam", changeset_revision="1"),
+        dict(name="bwa", owner="devteam", tool_shed_url=TOOL_SHED_URL, changeset_revision="2"),
+        dict(name="bwa", owner="devteam", changeset_revision="1", tool_shed_url="https://testtoolshed.g2.bx.psu.edu/"),
+    ]
+    unique = unique_repositories(repositories, default_toolshed=TOOL_SHED_URL)
+    # Exact duplicates collapse, and a missing tool_shed_url is the default tool shed
+    assert len(unique) == 3
+    # The first occurrence wins
+    assert unique[0] is repositories[0]
+    assert unique[1:] == repositories[3:]
+
+
+def test_install_latest_revision_once(monkeypatch):
+    monkeypatch.setattr(shed_tools_methods, "_INSTALLABLE_REVISIONS", {(TOOL_SHED_URL, "bwa", "devteam"): ("1", "2", "3")})
+    irm = install_repository_manager([installed_repository("bowtie2", ["1"])])
+    installed = []
+
+    def install_repository_revision(repository, log):
+        installed.append(repository['changeset_revision'])
+        return "installed"
+
+    irm.install_repository_revision = install_repository_revision
+    install_results = irm.install_repositories(
+        [dict(name="bwa", owner="devteam", tool_panel_section_label="NGS: Alignment", revisions=["1", "2"])],
+        force_latest_revision=True)
+    assert installed == ["3"]
+    assert len(install_results.installed_repositories) == 1
+
+
+def test_install_repository_without_tool_shed_url(monkeypatch):
+    monkeypatch.setattr(shed_tools_methods, "_INSTALLABLE_REVISIONS", {(TOOL_SHED_URL, "bwa", "devteam"): ("1", "2", "3")})
+    irm = install_repository_manager()
+    irm.install_repository_revision = lambda repository, log: "installed"
+    # An entry without a usable tool shed url is reported, and does not prevent the other installs.
+    install_results = irm.install_repositories(
+        [dict(name="bowtie2", owner="devteam", tool_shed_url=None, tool_panel_section_label="NGS: Alignment"),
+         dict(name="bwa", owner="devteam", tool_panel_section_label="NGS: Alignment")],
+        fail_fast=False)
+    assert [r["name"] for r in install_results.errored_repositories] == ["bowtie2"]
+    assert [r["name"] for r in install_results.installed_repositories] == ["bwa"]
+
+
+@pytest.mark.parametrize("error, result, waited", [
+    (ConnectionError("Gateway timeout", body="<html>504</html>", status_code=504), "installed", True),
+    (ConnectionError("Internal server error", body="Error", status_code=500), "error", False),
+    (requests.exceptions.ConnectionError("Connection refused"), "error", False),
+    (ConnectionError(ALREADY_INSTALLED_ERROR_MESSAGE, status_code=400), "skipped", False),
+])
+def test_install_repository_revision_connection_errors(error, result, waited):
+    class ToolShedClient(object):
+        def install_repository_revision(self, **kwargs):
+            raise error
+
+    waited_for = []
+
+    def wait_for_install(repository, log, timeout):
+        waited_for.append(repository['name'])
+        return True
+
+    irm = install_repository_manager()
+    irm.tool_shed_client = ToolShedClient()
+    irm.wait_for_install = wait_for_install
+    repository = dict(name="bwa", owner="devteam", tool_shed_url=TOOL_SHED_URL, changeset_revision="1",
+                      tool_panel_section_label="NGS: Alignment")
+    assert irm.install_repository_revision(repository, log=logging.getLogger()) == result
+    assert waited_for == (["bwa"] if waited else [])
+    assert repository['tool_panel_section_label'] == "NGS: Alignment"